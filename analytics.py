@@ -0,0 +1,232 @@
+"""电池数据分析：基于历史读数计算充放电速率、剩余时间、放电曲线和健康度趋势。
+
+读数以定长二进制记录追加保存，分析使用 NumPy 批量计算。已结束的充放电会话结果会被缓存，
+每次更新只重新计算最后一个（仍在进行中的）会话和新增的读数。
+"""
+import os
+
+import numpy as np
+
+# 历史记录格式：时间戳（秒）+ 电量百分比
+RECORD_DTYPE = np.dtype([('t', '<f8'), ('p', '<f4')])
+
+SESSION_GAP = 600  # 两次读数间隔超过该值（秒）视为新会话
+HYSTERESIS = 2  # 反向变化累计达到该百分点才视为充放电方向改变，过滤读数抖动
+RATE_WINDOW = 1800  # 估算当前速率使用的最近时间窗口（秒）
+MIN_RATE_SAMPLES = 3
+MIN_HEALTH_SPAN = 10  # 参与健康度估算的放电会话至少下降的百分点
+CURVE_POINTS = 100  # 放电曲线重采样点数
+Z_95 = 1.96
+
+
+class ReadingHistory:
+    """单个设备的读数历史，内存中使用可增长的 NumPy 数组，磁盘上追加写入"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.data = np.empty(1024, dtype=RECORD_DTYPE)
+        if os.path.exists(path):
+            # 追加写入中断（如断电）会留下不完整的末尾记录，截掉它，否则之后的记录全部错位
+            size = os.path.getsize(path)
+            complete = size - size % RECORD_DTYPE.itemsize
+            if size != complete:
+                os.truncate(path, complete)
+            loaded = np.fromfile(path, dtype=RECORD_DTYPE)
+            self._reserve(len(loaded))
+            self.data[:len(loaded)] = loaded
+            self.size = len(loaded)
+
+    def _reserve(self, size):
+        if size > len(self.data):
+            capacity = max(size, len(self.data) * 2)
+            data = np.empty(capacity, dtype=RECORD_DTYPE)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def append(self, timestamp, percentage):
+        """追加一条读数并写入磁盘"""
+        self._reserve(self.size + 1)
+        self.data[self.size] = (timestamp, percentage)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(self.data[self.size:self.size + 1].tobytes())
+        self.size += 1
+
+    @property
+    def timestamps(self):
+        return self.data['t'][:self.size]
+
+    @property
+    def percentages(self):
+        return self.data['p'][:self.size]
+
+
+def linear_fit(x, y):
+    """最小二乘直线拟合，返回 (斜率, 截距, 斜率标准误差)"""
+    n = len(x)
+    x_mean = x.mean()
+    y_mean = y.mean()
+    dx = x - x_mean
+    sxx = np.dot(dx, dx)
+    if sxx == 0:
+        return 0.0, float(y_mean), float('inf')
+    slope = np.dot(dx, y - y_mean) / sxx
+    intercept = y_mean - slope * x_mean
+    if n <= 2:
+        return float(slope), float(intercept), float('inf')
+    residuals = y - (slope * x + intercept)
+    stderr = np.sqrt(np.dot(residuals, residuals) / (n - 2) / sxx)
+    return float(slope), float(intercept), float(stderr)
+
+
+def split_sessions(t, p, offset=0):
+    """把读数切分为充放电会话，返回 [(起始下标, 结束下标), ...]（结束下标不含）"""
+    n = len(t)
+    if n == 0:
+        return []
+    boundaries = [0]
+
+    # 读数间隔过长处切分
+    gaps = np.flatnonzero(np.diff(t) > SESSION_GAP) + 1
+    for start, end in zip(np.r_[0, gaps], np.r_[gaps, n]):
+        if start > boundaries[-1]:
+            boundaries.append(int(start))
+
+        # 方向改变处切分：把同向变化合并为段，累计幅度不足的反向段视为抖动
+        steps = np.diff(p[start:end])
+        moved = np.flatnonzero(steps)
+        if len(moved) == 0:
+            continue
+        signs = np.sign(steps[moved])
+        run_starts = np.flatnonzero(np.r_[True, signs[1:] != signs[:-1]])
+        run_sizes = np.add.reduceat(np.abs(steps[moved]), run_starts)
+        significant = run_starts[run_sizes >= HYSTERESIS]
+        if len(significant) < 2:
+            continue
+        significant_signs = signs[significant]
+        turns = significant[1:][significant_signs[1:] != significant_signs[:-1]]
+        # 转折点为反向变化开始前的那条读数
+        boundaries.extend(int(start + moved[index]) for index in turns)
+
+    boundaries = sorted(set(boundaries))
+    return [(offset + a, offset + b) for a, b in zip(boundaries, boundaries[1:] + [n])]
+
+
+class BatteryAnalyzer:
+    """在读数历史上增量地计算会话统计、当前速率和健康度"""
+
+    def __init__(self, history):
+        self.history = history
+        self.closed_sessions = []  # 已结束会话的统计结果（缓存）
+        self.open_start = 0  # 最后一个会话的起始下标，之后的数据每次更新时重新计算
+
+    def session_stats(self, start, end):
+        t = self.history.timestamps[start:end]
+        p = self.history.percentages[start:end].astype(np.float64)
+        hours = (t - t[0]) / 3600
+        slope, _, _ = linear_fit(hours, p) if len(t) >= 2 else (0.0, 0.0, float('inf'))
+        change = float(p[-1] - p[0])
+        if change <= -HYSTERESIS:
+            kind = 'discharge'
+        elif change >= HYSTERESIS:
+            kind = 'charge'
+        else:
+            kind = 'idle'
+
+        # 放电曲线：按经过时间均匀重采样
+        grid = np.linspace(0, hours[-1], min(CURVE_POINTS, len(t)))
+        curve = np.column_stack((grid, np.interp(grid, hours, p)))
+        return {
+            'kind': kind,
+            'start': float(t[0]),
+            'end': float(t[-1]),
+            'start_percentage': float(p[0]),
+            'end_percentage': float(p[-1]),
+            'rate': slope,  # 百分点/小时，负数表示放电
+            'samples': end - start,
+            'curve': curve,
+        }
+
+    def update(self):
+        """处理新增读数：只重新切分最后一个会话及之后的数据"""
+        t = self.history.timestamps
+        p = self.history.percentages
+        sessions = split_sessions(t[self.open_start:], p[self.open_start:], self.open_start)
+        if not sessions:
+            return []
+        for start, end in sessions[:-1]:
+            self.closed_sessions.append(self.session_stats(start, end))
+        self.open_start = sessions[-1][0]
+        return self.closed_sessions + [self.session_stats(*sessions[-1])]
+
+    def current_rate(self):
+        """最近时间窗口内的速率及其 95% 置信区间（百分点/小时）"""
+        t = self.history.timestamps[self.open_start:]
+        p = self.history.percentages[self.open_start:]
+        if len(t) < MIN_RATE_SAMPLES:
+            return None
+        window_start = np.searchsorted(t, t[-1] - RATE_WINDOW)
+        if len(t) - window_start < MIN_RATE_SAMPLES:
+            window_start = len(t) - MIN_RATE_SAMPLES
+        hours = (t[window_start:] - t[-1]) / 3600
+        slope, _, stderr = linear_fit(hours, p[window_start:].astype(np.float64))
+        return slope, slope - Z_95 * stderr, slope + Z_95 * stderr
+
+    def health(self, sessions):
+        """根据各放电会话折算的满电续航时间估算健康度和衰减趋势"""
+        discharges = [s for s in sessions
+                      if s['kind'] == 'discharge' and s['rate'] < 0
+                      and s['start_percentage'] - s['end_percentage'] >= MIN_HEALTH_SPAN]
+        if not discharges:
+            return None
+        starts = np.array([s['start'] for s in discharges])
+        runtime = 100 / -np.array([s['rate'] for s in discharges])  # 满电续航（小时）
+
+        baseline = float(np.median(runtime[:3]))
+        recent = float(np.median(runtime[-3:]))
+        result = {
+            'sessions': len(discharges),
+            'runtime': recent,
+            'health': min(100.0, 100 * recent / baseline) if baseline > 0 else None,
+            'fade_per_30d': None,
+        }
+        if len(discharges) >= 3 and starts[-1] - starts[0] > 0:
+            days = (starts - starts[0]) / 86400
+            slope, _, _ = linear_fit(days, runtime)
+            result['fade_per_30d'] = -100 * slope * 30 / baseline if baseline > 0 else None
+        return result
+
+    def summary(self):
+        """汇总当前速率、剩余时间（含置信区间）、会话曲线和健康度"""
+        sessions = self.update()
+        if not sessions:
+            return {}
+        result = {'sessions': sessions, 'health': self.health(sessions)}
+
+        rate = self.current_rate()
+        if rate is None:
+            return result
+        slope, low, high = rate
+        percentage = float(self.history.percentages[-1])
+        result['rate'] = slope
+        if slope < 0:
+            # 放电越快（斜率越负）剩余时间越短
+            result['time_to_empty'] = (percentage / -slope,
+                                       percentage / -low,
+                                       percentage / -high if high < 0 else float('inf'))
+        elif slope > 0 and percentage < 100:
+            result['time_to_full'] = ((100 - percentage) / slope,
+                                      (100 - percentage) / high,
+                                      (100 - percentage) / low if low > 0 else float('inf'))
+        return result
+
+
+def format_hours(hours):
+    """把小时数格式化为简短文本"""
+    if hours == float('inf'):
+        return "∞"
+    minutes = int(round(hours * 60))
+    if minutes < 60:
+        return f"{minutes}分钟"
+    return f"{minutes // 60}小时{minutes % 60}分"
@@ -0,0 +1,362 @@
+"""多进程设备群监控：主管进程把串口分片给多个工作进程，
+工作进程把每台设备的最新读数写入共享内存表，托盘/命令行直接读取，无需进程间通信往返。"""
+import argparse
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import serial
+
+from protocol import PROTOCOLS
+
+# 设备群模式只查询电量，查询命令与应答格式与托盘程序共用
+BATTERY_COMMAND = PROTOCOLS.get('tntgo').commands['battery']
+QUERY_COMMAND = BATTERY_COMMAND.command + b'\r\n'
+
+# 共享内存表布局：表头 + 固定大小的槽位数组
+# 表头: 魔数, 版本, 槽位数
+HEADER_FORMAT = '<4sII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TABLE_MAGIC = b'TNTF'
+TABLE_VERSION = 1
+
+# 槽位: 序列号(seqlock), 电量(-1 表示未知), 状态, 时间戳, 串口名
+SLOT_FORMAT = '<IhBxd32s'
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+
+# 槽位状态
+STATUS_EMPTY = 0
+STATUS_CONNECTING = 1
+STATUS_OK = 2
+STATUS_ERROR = 3
+STATUS_NAMES = {
+    STATUS_EMPTY: "空闲",
+    STATUS_CONNECTING: "连接中",
+    STATUS_OK: "正常",
+    STATUS_ERROR: "错误",
+}
+
+
+def open_shared_memory(name, track=False):
+    """连接已有共享内存；track=False 时不让本进程的 resource_tracker 在退出时删除它"""
+    if track:
+        return shared_memory.SharedMemory(name=name)
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name != 'nt':
+        # POSIX 下旧版本会登记所有连接方，连接方退出时会把创建者的表一起删除
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class LatestValueTable:
+    """固定布局的共享内存最新值表。
+
+    每个槽位只由一个工作进程写入，写入方使用 seqlock：写前把序列号置为奇数，
+    写完再改为下一个偶数。读取方在序列号为偶数且前后一致时才认为读到了一致的数据，
+    因此读取端不需要任何锁。
+
+    写入方在写入中途崩溃会留下奇数序列号；写入时强制奇偶性，
+    主管进程在重启分片前也会用 reset() 把序列号恢复为偶数。
+    """
+
+    def __init__(self, shm, slot_count, owner):
+        self.shm = shm
+        self.slot_count = slot_count
+        self.owner = owner  # 创建者负责在关闭时释放共享内存
+
+    @classmethod
+    def create(cls, slot_count, name=None):
+        """创建新的共享内存表"""
+        size = HEADER_SIZE + SLOT_SIZE * slot_count
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        struct.pack_into(HEADER_FORMAT, shm.buf, 0, TABLE_MAGIC, TABLE_VERSION, slot_count)
+        return cls(shm, slot_count, owner=True)
+
+    @classmethod
+    def attach(cls, name, track=False):
+        """按名称连接到已有的共享内存表。
+
+        工作进程与创建者共用同一个 resource_tracker，需传入 track=True；
+        托盘等独立进程保持默认，避免退出时误删创建者的表。
+        """
+        shm = open_shared_memory(name, track)
+        magic, version, slot_count = struct.unpack_from(HEADER_FORMAT, shm.buf, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            shm.close()
+            raise ValueError(f"共享内存 {name} 不是有效的电量表")
+        return cls(shm, slot_count, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _offset(self, index):
+        if not 0 <= index < self.slot_count:
+            raise IndexError(f"槽位 {index} 超出范围 (共 {self.slot_count} 个)")
+        return HEADER_SIZE + index * SLOT_SIZE
+
+    def write(self, index, port, percentage, status, timestamp=None):
+        """写入一个槽位（仅由拥有该槽位的工作进程调用）"""
+        offset = self._offset(index)
+        buf = self.shm.buf
+        if timestamp is None:
+            timestamp = time.time()
+        if percentage is None:
+            percentage = -1
+
+        seq = struct.unpack_from('<I', buf, offset)[0]
+        # 奇数序列号表示正在写入；上次写入中途崩溃时 seq 已是奇数，按位或保证奇偶性不会反转
+        writing = seq | 1
+        struct.pack_into('<I', buf, offset, writing)
+        struct.pack_into(SLOT_FORMAT, buf, offset, writing,
+                         int(percentage), status, timestamp, port.encode()[:32])
+        struct.pack_into('<I', buf, offset, (writing + 1) & 0xFFFFFFFF)
+
+    def reset(self, index):
+        """把写入中途崩溃留下的奇数序列号恢复为偶数（仅在该槽位没有写入方时调用）"""
+        offset = self._offset(index)
+        seq = struct.unpack_from('<I', self.shm.buf, offset)[0]
+        if seq & 1:
+            struct.pack_into('<I', self.shm.buf, offset, (seq + 1) & 0xFFFFFFFF)
+
+    def read(self, index, retries=100):
+        """读取一个槽位，返回 (串口, 电量, 状态, 时间戳)；写入冲突时让出CPU后重试，
+        始终无法读到一致数据时返回 None（槽位忙）"""
+        offset = self._offset(index)
+        buf = self.shm.buf
+        for _ in range(retries):
+            seq_before = struct.unpack_from('<I', buf, offset)[0]
+            if not seq_before & 1:
+                _, percentage, status, timestamp, port = struct.unpack_from(SLOT_FORMAT, buf, offset)
+                seq_after = struct.unpack_from('<I', buf, offset)[0]
+                if seq_before == seq_after:
+                    port = port.rstrip(b'\x00').decode(errors='replace')
+                    return port, (None if percentage < 0 else percentage), status, timestamp
+            # 写入方可能在写入中途被调度出去，让出时间片等待其完成
+            time.sleep(0)
+        return None
+
+    def read_all(self):
+        """读取所有非空槽位，忙的槽位本次跳过"""
+        rows = []
+        for index in range(self.slot_count):
+            row = self.read(index)
+            if row is not None and row[2] != STATUS_EMPTY:
+                rows.append(row)
+        return rows
+
+    def find(self, port):
+        """按串口名查找槽位，返回读数或 None（未找到或槽位忙）"""
+        for index in range(self.slot_count):
+            row = self.read(index)
+            if row is not None and row[2] != STATUS_EMPTY and row[0] == port:
+                return row
+        return None
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def fleet_worker(table_name, assignments, baudrate, query_interval, stop_event):
+    """工作进程：在一个循环中非阻塞地轮询分配到的所有串口"""
+    table = LatestValueTable.attach(table_name, track=True)
+    devices = [init_device(table, index, port) for index, port in assignments]
+
+    try:
+        while not stop_event.is_set():
+            now = time.time()
+            for device in devices:
+                poll_device(table, device, now, baudrate, query_interval)
+            # 短暂休眠，避免CPU占用过高
+            time.sleep(0.05)
+    finally:
+        for device in devices:
+            if device['serial'] is not None and device['serial'].is_open:
+                device['serial'].close()
+        table.close()
+
+
+def init_device(table, index, port):
+    """创建设备的轮询状态并把槽位标记为连接中；重启的工作进程沿用槽位中上次的读数"""
+    percentage, timestamp = None, None
+    row = table.read(index)
+    if row is not None and row[2] != STATUS_EMPTY and row[0] == port:
+        percentage, timestamp = row[1], row[3]
+    table.write(index, port, percentage, STATUS_CONNECTING, timestamp)
+    return {
+        'index': index,
+        'port': port,
+        'serial': None,
+        'buffer': b'',
+        'acquired': False,
+        'last_query': 0.0,
+        'next_retry': 0.0,
+        'percentage': percentage,
+    }
+
+
+def poll_device(table, device, now, baudrate, query_interval):
+    """对单个设备执行一次轮询：必要时连接、读取应答、按策略发送查询"""
+    if device['serial'] is None:
+        if now < device['next_retry']:
+            return
+        try:
+            device['serial'] = serial.Serial(device['port'], int(baudrate), timeout=0)
+            device['serial'].write(QUERY_COMMAND)
+            device['last_query'] = now
+        except Exception:
+            device['serial'] = None
+            device['next_retry'] = now + 5
+            table.write(device['index'], device['port'], device['percentage'], STATUS_ERROR)
+            return
+
+    try:
+        waiting = device['serial'].in_waiting
+        if waiting:
+            device['buffer'] += device['serial'].read(waiting)
+            *lines, device['buffer'] = device['buffer'].split(b'\n')
+            for line in lines:
+                match = BATTERY_COMMAND.pattern.search(line.decode(errors='replace'))
+                if match:
+                    device['percentage'] = BATTERY_COMMAND.decode(match)['percentage']
+                    device['acquired'] = True
+                    table.write(device['index'], device['port'], device['percentage'], STATUS_OK, now)
+
+        # 与托盘程序相同的策略：未获取电量前每0.5秒查询，获取后按间隔查询
+        interval = query_interval if device['acquired'] else 0.5
+        if now - device['last_query'] >= interval:
+            device['serial'].write(QUERY_COMMAND)
+            device['last_query'] = now
+    except Exception:
+        try:
+            device['serial'].close()
+        except Exception:
+            pass
+        device['serial'] = None
+        device['buffer'] = b''
+        device['acquired'] = False
+        device['next_retry'] = now + 5
+        table.write(device['index'], device['port'], device['percentage'], STATUS_ERROR)
+
+
+class FleetSupervisor:
+    """主管进程：把串口分片给工作进程池，并在工作进程崩溃时单独重启该分片"""
+
+    def __init__(self, ports, workers=None, baudrate=115200, query_interval=30, table_name=None):
+        self.ports = list(ports)
+        self.workers = max(1, min(workers or multiprocessing.cpu_count(), len(self.ports)))
+        self.baudrate = baudrate
+        self.query_interval = query_interval
+        self.table = LatestValueTable.create(len(self.ports), name=table_name)
+        self.stop_event = multiprocessing.Event()
+        self.processes = {}
+        self.restarts = {}
+
+        # 轮转分片，使每个工作进程负责的设备数量尽量均衡
+        self.shards = [[] for _ in range(self.workers)]
+        for index, port in enumerate(self.ports):
+            self.shards[index % self.workers].append((index, port))
+
+    def start_shard(self, shard_id):
+        process = multiprocessing.Process(
+            target=fleet_worker,
+            args=(self.table.name, self.shards[shard_id], self.baudrate, self.query_interval, self.stop_event),
+            name=f"fleet-worker-{shard_id}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard_id] = process
+
+    def start(self):
+        for shard_id in range(self.workers):
+            self.restarts[shard_id] = 0
+            self.start_shard(shard_id)
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+
+    def monitor(self):
+        """检查工作进程存活情况，崩溃的分片单独重启，不影响其他分片"""
+        while not self.stop_event.is_set():
+            for shard_id, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stop_event.is_set():
+                    self.restarts[shard_id] += 1
+                    print(f"工作进程 {shard_id} 已退出 (代码 {process.exitcode})，正在重启", file=sys.stderr)
+                    for index, port in self.shards[shard_id]:
+                        # 工作进程可能在写入中途退出，先恢复序列号再保留上次的读数
+                        self.table.reset(index)
+                        row = self.table.read(index)
+                        percentage, timestamp = (row[1], row[3]) if row is not None else (None, 0.0)
+                        self.table.write(index, port, percentage, STATUS_CONNECTING, timestamp)
+                    self.start_shard(shard_id)
+            time.sleep(1)
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.table.close()
+
+
+def print_table(rows):
+    now = time.time()
+    print(f"{'串口':<12}{'电量':>6}  {'状态':<6}{'更新于':>8}")
+    for port, percentage, status, timestamp in rows:
+        value = "--" if percentage is None else f"{percentage}%"
+        age = f"{now - timestamp:.0f}秒前" if timestamp else "--"
+        print(f"{port:<12}{value:>6}  {STATUS_NAMES.get(status, '?'):<6}{age:>8}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程设备群电量监控")
+    parser.add_argument('--ports', nargs='+', help="要监控的串口列表")
+    parser.add_argument('--workers', type=int, default=None, help="工作进程数量（默认CPU核数）")
+    parser.add_argument('--baudrate', type=int, default=115200, help="波特率")
+    parser.add_argument('--interval', type=int, default=30, help="获取电量后的查询间隔（秒）")
+    parser.add_argument('--table-name', default="tntgo_fleet", help="共享内存表名称")
+    parser.add_argument('--watch', action='store_true', help="只连接已有的共享内存表并显示读数")
+    parser.add_argument('--refresh', type=float, default=2, help="显示刷新间隔（秒）")
+    args = parser.parse_args()
+
+    if args.watch:
+        table = LatestValueTable.attach(args.table_name)
+        try:
+            while True:
+                print_table(table.read_all())
+                time.sleep(args.refresh)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            table.close()
+        return
+
+    if not args.ports:
+        parser.error("需要指定 --ports 或 --watch")
+
+    supervisor = FleetSupervisor(args.ports, args.workers, args.baudrate, args.interval, args.table_name)
+    supervisor.start()
+    print(f"已启动 {supervisor.workers} 个工作进程，监控 {len(args.ports)} 个串口，共享内存表: {supervisor.table.name}")
+    try:
+        while True:
+            print_table(supervisor.table.read_all())
+            time.sleep(args.refresh)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -2,7 +2,6 @@ import tkinter as tk
 from tkinter import ttk
 import serial
 import threading
-import re
 import time
 import pystray
 from PIL import Image, ImageDraw, ImageFont
@@ -10,20 +9,71 @@ import os
 import json
 import winreg
 import sys
+import argparse
+import base64
+import io
+
+from fleet import LatestValueTable, STATUS_OK
+from tracing import Tracer, OnDemandProfiler
+from protocol import QueryPipeline, DeviceProtocol, PROTOCOLS, DEFAULT_PROTOCOLS, format_telemetry
+from analytics import ReadingHistory, BatteryAnalyzer, format_hours
+
+
+class MonitorState:
+    """连接与读数状态的不可变快照。
+
+    串口线程、托盘回调线程和 Tk 主循环线程共享同一个 state 引用：读取方一次取得引用即可
+    得到一致的状态，无需加锁；修改方通过 replace() 生成新快照后整体替换。
+    """
+    __slots__ = ('running', 'port', 'baudrate', 'serial_port', 'current_battery',
+                 'battery_acquired', 'telemetry', 'analysis', 'reading_time', 'stale')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MonitorState 是不可变对象，请使用 replace()")
+
+    def replace(self, **changes):
+        """返回应用了修改的新快照"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return MonitorState(**fields)
 
 
 class BatteryMonitorApp:
-    def __init__(self):
+    def __init__(self, data_dir=None, serial_factory=None):
+        # 数据目录，默认为用户主目录；浸泡测试等场景可指定临时目录
+        data_dir = data_dir or os.path.expanduser("~")
+
         # 配置文件路径
-        self.config_file = os.path.join(os.path.expanduser("~"), "battery_monitor_config.json")
+        self.config_file = os.path.join(data_dir, "battery_monitor_config.json")
+        # 上次运行状态（最后读数、可用串口、已绘制的图标），用于启动时立即显示
+        self.state_file = os.path.join(data_dir, "battery_monitor_state.json")
+
+        # 连接与读数状态，整体替换以保证各线程读到一致的快照
+        self.state = MonitorState(
+            running=False,
+            port="COM3",  # 默认串口
+            baudrate=115200,  # 默认波特率
+            serial_port=None,
+            current_battery="--",
+            battery_acquired=False,  # 标记是否已获取到电量
+            telemetry={},  # 最近一次查询得到的附加遥测数据（电压、温度等）
+            analysis={},  # 最近一次电池分析结果
+            reading_time=None,  # 当前电量的读取时间
+            stale=False,  # 当前电量是否为上次运行保存的旧读数
+        )
+        self._state_lock = threading.Lock()  # 只在修改状态时使用，读取无需加锁
 
         # 默认设置
-        self.serial_port = None
-        self.running = False
-        self.current_battery = "--"
-        self.port = "COM3"  # 默认串口
-        self.baudrate = 115200  # 默认波特率
-        self.battery_acquired = False  # 标记是否已获取到电量
+        self.serial_timeout = 0.1  # 串口读取超时（秒）
+        self.serial_factory = serial_factory or serial.Serial  # 创建串口对象，浸泡测试时替换为模拟设备
+        self.poll_delay = 0.1  # 串口读取循环每轮的休眠时间（秒）
+        self.error_delay = 1  # 读取出错后的等待时间（秒）
+        self.reconnect_delay = 5  # 串口打开失败后自动重连前的等待时间（秒）
+        self.pending_reconfig = None  # 等待串口线程应用的 (串口, 波特率, 超时) 设置
         self.query_interval = 30  # 成功获取电量后的查询间隔（秒）
         self.icon_style = "battery"  # 默认图标样式: "battery" 或 "number"
         self.icon_size = 96  # 图标尺寸，更大的图标
@@ -31,22 +81,59 @@ class BatteryMonitorApp:
         self.number_font_size = 0.7  # 纯数字图标的字体大小比例，默认0.7
         self.battery_size = 0.8  # 电池图标的大小比例，默认0.8 (80%)
         self.auto_start = False  # 开机自启动，默认关闭
+        self.fleet_table = ""  # 设备群共享内存表名称，非空时从表中读取电量而不直接打开串口
+        self.protocols = list(DEFAULT_PROTOCOLS)  # 启用的设备协议
+        self.custom_protocols = []  # 配置文件中自定义的设备协议
+        self.query_commands = []  # 除各协议默认命令外额外开启的查询命令
+        self.history_dir = os.path.join(data_dir, "battery_monitor_history")  # 读数历史目录
+        self.analyzers = {}  # 每个串口一个分析器
+
+        # 性能追踪与按需分析（默认关闭）
+        self.tracer = Tracer()
+        self.profile_dir = os.path.join(data_dir, "battery_monitor_profiles")
+        self.profiler = OnDemandProfiler(self.profile_dir, log=self.display_data)
+        self.trace_on_exit = False  # 退出时是否自动导出追踪记录
+        self.trace_output = None  # 追踪导出路径，None 表示保存到分析目录
+        self.warm_icon = None  # 上次保存的图标，启动时直接使用
+        self.warm_connection = None  # 上次可用的 (串口, 波特率)，首次连接时优先尝试
+        self.working_connection = None  # 最近一次成功获取电量的 (串口, 波特率)，保存供下次启动使用
+        self.last_icon = None  # 最近一次绘制的图标（未变暗）
+        self.last_icon_key = None  # 绘制 last_icon 时的绘制设置
+        self.last_state_save = 0  # 上次保存运行状态的时间
+        self.state_save_interval = 60  # 定期保存运行状态的间隔（秒）
 
         # 加载配置
         self.load_config()
 
+        # 恢复上次的读数和图标
+        self.load_warm_state()
+
         # 创建初始托盘图标
         self.create_tray_icon()
 
         # 应用启动后自动开始监控
         self.start_reading()
 
+    def update_state(self, **changes):
+        """以新快照替换当前状态，返回替换前的快照"""
+        with self._state_lock:
+            previous = self.state
+            self.state = previous.replace(**changes)
+        return previous
+
     def create_tray_icon(self):
-        # 创建初始图标
-        icon_image = self.create_icon_by_style(self.current_battery)
+        # 创建初始图标，有上次保存的图标时直接使用
+        state = self.state
+        if self.warm_icon is not None:
+            icon_image = self.dim_icon(self.warm_icon)
+            self.last_icon = self.warm_icon
+            self.last_icon_key = self.icon_key()
+            self.warm_icon = None
+        else:
+            icon_image = self.create_icon_by_style(state.current_battery)
 
         # 创建系统托盘图标
-        self.icon = pystray.Icon("battery_monitor", icon_image, f"电池电量: {self.current_battery}%")
+        self.icon = pystray.Icon("battery_monitor", icon_image, self.battery_title(state))
 
         # 创建菜单
         self.icon.menu = self.create_menu()
@@ -97,6 +184,15 @@ class BatteryMonitorApp:
             ))
         battery_size_submenu = pystray.Menu(*battery_size_items)
 
+        # 创建调试子菜单
+        debug_submenu = pystray.Menu(
+            pystray.MenuItem('记录性能追踪', lambda _: self.toggle_tracing(),
+                             checked=lambda _: self.tracer.enabled),
+            pystray.MenuItem('导出追踪文件', lambda _: self.export_trace()),
+            pystray.MenuItem('cProfile分析10秒', lambda _: self.profiler.start("cprofile", 10)),
+            pystray.MenuItem('采样分析10秒', lambda _: self.profiler.start("sample", 10))
+        )
+
         # 创建设置子菜单
         settings_submenu = pystray.Menu(
             pystray.MenuItem('设置面板', lambda _: self.show_settings_panel()),
@@ -106,11 +202,15 @@ class BatteryMonitorApp:
             pystray.MenuItem('数字大小', number_font_submenu),
             pystray.MenuItem('电池大小', battery_size_submenu),
             pystray.MenuItem('开机自启', lambda _: self.toggle_auto_start(),
-                             checked=lambda _: self.auto_start)
+                             checked=lambda _: self.auto_start),
+            pystray.MenuItem('调试', debug_submenu)
         )
 
         # 电池电量显示始终使用最新状态
-        battery_status = f'电池电量: {self.current_battery}%'
+        state = self.state
+        battery_status = f'电池电量: {state.current_battery}%'
+        if state.stale:
+            battery_status += ' (旧读数)'
 
         # 创建并返回完整菜单
         return pystray.Menu(
@@ -132,6 +232,27 @@ class BatteryMonitorApp:
         self.save_config()
         self.update_menu()
 
+    def toggle_tracing(self):
+        """切换性能追踪记录"""
+        self.tracer.enabled = not self.tracer.enabled
+        if self.tracer.enabled:
+            self.tracer.clear()
+        status = "开启" if self.tracer.enabled else "关闭"
+        self.display_data(f"性能追踪已{status}\n")
+        self.update_menu()
+
+    def export_trace(self, path=None):
+        """导出追踪记录为 Chrome trace-event JSON 文件"""
+        if path is None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+            path = os.path.join(self.profile_dir, f"trace-{stamp}.json")
+        try:
+            count = self.tracer.export_chrome_trace(path)
+            self.display_data(f"已导出 {count} 条追踪记录到 {path}\n")
+        except Exception as e:
+            self.display_data(f"导出追踪文件失败: {str(e)}\n")
+
     def set_auto_start(self, enable):
         """设置或移除开机自启动注册表项"""
         # 获取当前程序的完整路径
@@ -177,14 +298,20 @@ class BatteryMonitorApp:
 
     def save_config(self):
         """保存配置到文件"""
+        state = self.state
         config = {
-            'port': self.port,
-            'baudrate': self.baudrate,
+            'port': state.port,
+            'baudrate': state.baudrate,
+            'serial_timeout': self.serial_timeout,
             'query_interval': self.query_interval,
             'icon_style': self.icon_style,
             'number_font_size': self.number_font_size,
             'battery_size': self.battery_size,
-            'auto_start': self.auto_start
+            'auto_start': self.auto_start,
+            'fleet_table': self.fleet_table,
+            'protocols': self.protocols,
+            'custom_protocols': self.custom_protocols,
+            'query_commands': self.query_commands
         }
 
         try:
@@ -204,12 +331,19 @@ class BatteryMonitorApp:
                     config = json.load(f)
 
                 # 更新配置
-                if 'port' in config: self.port = config['port']
-                if 'baudrate' in config: self.baudrate = config['baudrate']
+                if 'port' in config: self.update_state(port=config['port'])
+                if 'baudrate' in config: self.update_state(baudrate=config['baudrate'])
+                if 'serial_timeout' in config: self.serial_timeout = config['serial_timeout']
                 if 'query_interval' in config: self.query_interval = config['query_interval']
                 if 'icon_style' in config: self.icon_style = config['icon_style']
                 if 'number_font_size' in config: self.number_font_size = config['number_font_size']
                 if 'battery_size' in config: self.battery_size = config['battery_size']
+                if 'fleet_table' in config: self.fleet_table = config['fleet_table']
+                if 'query_commands' in config: self.query_commands = config['query_commands']
+                if 'protocols' in config: self.protocols = config['protocols']
+                if 'custom_protocols' in config:
+                    self.custom_protocols = config['custom_protocols']
+                    self.register_custom_protocols()
                 if 'auto_start' in config:
                     self.auto_start = config['auto_start']
                     # 确保注册表状态与配置一致
@@ -224,9 +358,90 @@ class BatteryMonitorApp:
             self.display_data(f"加载配置文件失败: {str(e)}，使用默认设置\n")
             return False
 
+    def register_custom_protocols(self):
+        """把配置文件中自定义的设备协议注册到协议注册表"""
+        for item in self.custom_protocols:
+            try:
+                PROTOCOLS.register(DeviceProtocol.from_config(item))
+            except Exception as e:
+                self.display_data(f"自定义协议 {item.get('name', '?')} 无效: {str(e)}\n")
+
+    def build_query_pipeline(self):
+        """按启用的协议创建查询流水线；没有可获取电量的命令时改用默认协议"""
+        unknown = [name for name in self.protocols if name not in PROTOCOLS.protocols]
+        if unknown:
+            self.display_data(f"未知的协议: {', '.join(unknown)}\n")
+        commands = PROTOCOLS.select(self.protocols, self.query_commands)
+        if not any('percentage' in command.fields for command in commands):
+            self.display_data(f"启用的协议中没有可获取电量的命令，改用默认协议 {', '.join(DEFAULT_PROTOCOLS)}\n")
+            commands = PROTOCOLS.select(DEFAULT_PROTOCOLS, self.query_commands)
+        return QueryPipeline(commands, log=self.display_data)
+
+    def icon_key(self):
+        """影响图标绘制结果的设置，用于判断保存的图标是否仍然可用"""
+        size = self.battery_size if self.icon_style == "battery" else self.number_font_size
+        return [self.icon_style, self.icon_size, size]
+
+    def save_warm_state(self):
+        """保存最后读数、可用的串口设置和已绘制的图标"""
+        state = self.state
+        if state.reading_time is None or self.working_connection is None:
+            return False
+        # 保存实际获取到电量的串口设置，而不是当前配置（配置可能是无法连接的串口）
+        port, baudrate = self.working_connection
+        warm_state = {
+            'percentage': state.current_battery,
+            'timestamp': state.reading_time,
+            'port': port,
+            'baudrate': baudrate,
+        }
+        icon = self.last_icon
+        if icon is not None:
+            buffer = io.BytesIO()
+            icon.save(buffer, format='PNG')
+            warm_state['icon'] = base64.b64encode(buffer.getvalue()).decode('ascii')
+            warm_state['icon_key'] = self.last_icon_key
+
+        try:
+            with open(self.state_file, 'w') as f:
+                json.dump(warm_state, f)
+            self.last_state_save = time.time()
+            return True
+        except Exception as e:
+            self.display_data(f"保存运行状态失败: {str(e)}\n")
+            return False
+
+    def load_warm_state(self):
+        """启动时恢复上次的读数和图标，在获取到新读数前标记为旧读数"""
+        try:
+            if not os.path.exists(self.state_file):
+                return False
+            with open(self.state_file, 'r') as f:
+                warm_state = json.load(f)
+
+            self.update_state(current_battery=warm_state['percentage'],
+                              reading_time=warm_state['timestamp'],
+                              stale=True)
+            self.warm_connection = (warm_state['port'], warm_state['baudrate'])
+            self.working_connection = self.warm_connection
+
+            # 绘制设置未变化时直接使用保存的图标，无需重新绘制
+            if 'icon' in warm_state and warm_state.get('icon_key') == self.icon_key():
+                icon_bytes = base64.b64decode(warm_state['icon'])
+                self.warm_icon = Image.open(io.BytesIO(icon_bytes))
+                self.warm_icon.load()
+
+            reading_time = time.strftime("%m-%d %H:%M", time.localtime(warm_state['timestamp']))
+            self.display_data(f"已恢复上次读数 {warm_state['percentage']}% ({reading_time})\n")
+            return True
+        except Exception as e:
+            self.display_data(f"恢复运行状态失败: {str(e)}\n")
+            return False
+
     def update_menu(self):
         """更新菜单以反映当前状态"""
-        self.icon.menu = self.create_menu()
+        with self.tracer.span("update_menu"):
+            self.icon.menu = self.create_menu()
 
     def submenu_port(self):
         # 创建串口选择子菜单
@@ -244,7 +459,7 @@ class BatteryMonitorApp:
             items.append(pystray.MenuItem(
                 port,
                 make_port_handler(port),
-                checked=lambda _, p=port: self.port == p
+                checked=lambda _, p=port: self.state.port == p
             ))
         return pystray.Menu(*items)
 
@@ -264,7 +479,7 @@ class BatteryMonitorApp:
             items.append(pystray.MenuItem(
                 str(baud),
                 make_baud_handler(baud),
-                checked=lambda _, b=baud: self.baudrate == b
+                checked=lambda _, b=baud: self.state.baudrate == b
             ))
         return pystray.Menu(*items)
 
@@ -290,23 +505,23 @@ class BatteryMonitorApp:
 
     def change_port(self, new_port):
         """更改串口设置"""
-        if new_port != self.port:
-            self.port = new_port
-            self.display_data(f"串口已更改为: {self.port}\n")
+        if new_port != self.state.port:
+            self.update_state(port=new_port)
+            self.display_data(f"串口已更改为: {new_port}\n")
             # 保存配置
             self.save_config()
-            # 需要重新连接
-            self.reconnect()
+            # 由串口线程先打开新串口，确认有应答后再切换
+            self.request_reconfigure()
 
     def change_baudrate(self, new_baudrate):
         """更改波特率设置"""
-        if new_baudrate != self.baudrate:
-            self.baudrate = new_baudrate
-            self.display_data(f"波特率已更改为: {self.baudrate}\n")
+        if new_baudrate != self.state.baudrate:
+            self.update_state(baudrate=new_baudrate)
+            self.display_data(f"波特率已更改为: {new_baudrate}\n")
             # 保存配置
             self.save_config()
-            # 需要重新连接
-            self.reconnect()
+            # 在已打开的串口上直接修改，无需重新连接
+            self.request_reconfigure()
 
     def change_interval(self, new_interval):
         """更改查询间隔设置"""
@@ -330,7 +545,7 @@ class BatteryMonitorApp:
 
             # 如果当前使用的是纯数字图标，则立即更新图标
             if self.icon_style == "number":
-                new_icon = self.create_icon_by_style(self.current_battery)
+                new_icon = self.create_icon_by_style(self.state.current_battery)
                 self.icon.icon = new_icon
                 self.display_data("已更新图标\n")
 
@@ -351,18 +566,23 @@ class BatteryMonitorApp:
 
             # 如果当前使用的是电池图标，则立即更新图标
             if self.icon_style == "battery":
-                new_icon = self.create_icon_by_style(self.current_battery)
+                new_icon = self.create_icon_by_style(self.state.current_battery)
                 self.icon.icon = new_icon
                 self.display_data("已更新图标\n")
 
             # 更新菜单
             self.update_menu()
 
+    def request_reconfigure(self):
+        """请求串口线程在下一次循环时应用新的串口设置，不阻塞调用线程"""
+        state = self.state
+        self.pending_reconfig = (state.port, int(state.baudrate), float(self.serial_timeout))
+
     def reconnect(self):
         """重新连接串口"""
         self.stop_reading()
         time.sleep(1)  # 短暂等待确保串口关闭
-        self.battery_acquired = False  # 重置电量获取状态
+        self.update_state(battery_acquired=False)  # 重置电量获取状态
         self.start_reading()
 
     def change_icon_style(self, style):
@@ -375,7 +595,7 @@ class BatteryMonitorApp:
             self.save_config()
 
             # 更新图标
-            new_icon = self.create_icon_by_style(self.current_battery)
+            new_icon = self.create_icon_by_style(self.state.current_battery)
             self.icon.icon = new_icon
 
             # 更新菜单
@@ -384,9 +604,22 @@ class BatteryMonitorApp:
     def create_icon_by_style(self, percentage):
         """根据当前样式创建图标"""
         if self.icon_style == "battery":
-            return self.create_battery_icon(percentage)
+            image = self.create_battery_icon(percentage)
         else:
-            return self.create_number_icon(percentage)
+            image = self.create_number_icon(percentage)
+        # 记录图标及其绘制设置，样式或大小变化后重新绘制时一并更新
+        self.last_icon = image
+        self.last_icon_key = self.icon_key()
+        # 旧读数的图标以半透明显示
+        if self.state.stale:
+            return self.dim_icon(image)
+        return image
+
+    def dim_icon(self, image):
+        """返回半透明的图标副本，用于标记旧读数"""
+        image = image.convert('RGBA')
+        image.putalpha(image.getchannel('A').point(lambda alpha: alpha // 2))
+        return image
 
     def create_battery_icon(self, percentage):
         """创建电池样式图标 - 无数字版本，大小可调"""
@@ -493,6 +726,9 @@ class BatteryMonitorApp:
             self.root.lift()
             return
 
+        # 取得一份一致的状态快照用于初始化界面
+        state = self.state
+
         # 创建设置窗口
         self.root = tk.Tk()
         self.root.title("电量监控设置")
@@ -511,7 +747,7 @@ class BatteryMonitorApp:
         ttk.Label(port_frame, text="串口号:").pack(side=tk.LEFT)
         self.port_combo = ttk.Combobox(port_frame, values=[f'COM{i}' for i in range(1, 21)], width=15)
         self.port_combo.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
-        self.port_combo.set(self.port)
+        self.port_combo.set(state.port)
 
         # 波特率选择
         baud_frame = ttk.Frame(settings_frame)
@@ -519,7 +755,7 @@ class BatteryMonitorApp:
         ttk.Label(baud_frame, text="波特率:").pack(side=tk.LEFT)
         self.baudrate_combo = ttk.Combobox(baud_frame, values=[9600, 19200, 38400, 57600, 115200], width=15)
         self.baudrate_combo.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
-        self.baudrate_combo.set(self.baudrate)
+        self.baudrate_combo.set(state.baudrate)
 
         # 查询间隔选择
         interval_frame = ttk.Frame(settings_frame)
@@ -529,6 +765,14 @@ class BatteryMonitorApp:
         self.interval_combo.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
         self.interval_combo.set(self.query_interval)
 
+        # 读取超时选择
+        timeout_frame = ttk.Frame(settings_frame)
+        timeout_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(timeout_frame, text="读取超时(秒):").pack(side=tk.LEFT)
+        self.timeout_combo = ttk.Combobox(timeout_frame, values=[0.05, 0.1, 0.2, 0.5, 1.0], width=15)
+        self.timeout_combo.pack(side=tk.RIGHT, expand=True, fill=tk.X, padx=5)
+        self.timeout_combo.set(self.serial_timeout)
+
         # 图标样式选择
         style_frame = ttk.Frame(settings_frame)
         style_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -570,7 +814,7 @@ class BatteryMonitorApp:
         control_frame = ttk.Frame(main_frame)
         control_frame.pack(fill=tk.X, padx=5, pady=5)
 
-        if not self.running:
+        if not state.running:
             start_state = tk.NORMAL
             stop_state = tk.DISABLED
         else:
@@ -590,14 +834,20 @@ class BatteryMonitorApp:
         status_frame = ttk.LabelFrame(main_frame, text="电量状态", padding="5")
         status_frame.pack(fill=tk.X, padx=5, pady=5)
 
-        self.battery_label = ttk.Label(status_frame, text=f"当前电量: {self.current_battery}%", font=("Helvetica", 16))
+        self.battery_label = ttk.Label(status_frame, text=f"当前电量: {state.current_battery}%", font=("Helvetica", 16))
         self.battery_label.pack(padx=5, pady=5)
 
         # 电量状态标签
-        status_text = "已获取电量" if self.battery_acquired else "等待获取电量..."
+        status_text = "已获取电量" if state.battery_acquired else "等待获取电量..."
         self.status_label = ttk.Label(status_frame, text=status_text)
         self.status_label.pack(padx=5, pady=2)
 
+        # 电池分析结果
+        analysis_frame = ttk.LabelFrame(main_frame, text="电池分析", padding="5")
+        analysis_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.analysis_label = ttk.Label(analysis_frame, text=self.analysis_text(state.analysis), justify=tk.LEFT)
+        self.analysis_label.pack(anchor=tk.W, padx=5, pady=2)
+
         # 日志框架
         log_frame = ttk.LabelFrame(main_frame, text="通信日志", padding="5")
         log_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -622,7 +872,7 @@ class BatteryMonitorApp:
         self.clear_log_button.pack(side=tk.RIGHT, padx=5)
 
         # 设置窗口大小和位置
-        self.root.geometry("500x700")  # 增加窗口高度以适应新增的设置
+        self.root.geometry("500x820")  # 增加窗口高度以适应新增的设置
         self.root.minsize(400, 500)  # 设置最小窗口大小
         self.center_window(self.root)
 
@@ -662,19 +912,19 @@ class BatteryMonitorApp:
         new_port = self.port_combo.get()
         new_baudrate = int(self.baudrate_combo.get())
         new_interval = int(self.interval_combo.get())
+        new_timeout = float(self.timeout_combo.get())
         new_style = self.style_var.get()
         new_font_size = float(self.font_size_combo.get())
         new_battery_size = float(self.battery_size_combo.get())
         new_auto_start = self.autostart_var.get()
 
-        # 检查是否需要重启监控
-        restart_needed = self.running and (new_port != self.port or new_baudrate != self.baudrate)
+        # 检查串口设置是否变化，变化时由串口线程原地应用，不中断监控
+        state = self.state
+        reconfig_needed = (new_port != state.port or new_baudrate != state.baudrate or
+                           abs(new_timeout - self.serial_timeout) > 0.001)
 
-        if restart_needed:
-            self.stop_reading()
-
-        self.port = new_port
-        self.baudrate = new_baudrate
+        self.update_state(port=new_port, baudrate=new_baudrate)
+        self.serial_timeout = new_timeout
         self.query_interval = new_interval
 
         # 检查是否需要更新图标
@@ -706,7 +956,7 @@ class BatteryMonitorApp:
 
         # 如果需要，更新图标
         if icon_update_needed:
-            new_icon = self.create_icon_by_style(self.current_battery)
+            new_icon = self.create_icon_by_style(self.state.current_battery)
             self.icon.icon = new_icon
 
         # 保存配置
@@ -715,31 +965,28 @@ class BatteryMonitorApp:
         # 更新菜单以反映新的选择状态
         self.update_menu()
 
-        self.display_data(f"设置已更新: 端口={self.port}, 波特率={self.baudrate}, 查询间隔={self.query_interval}秒\n")
+        self.display_data(f"设置已更新: 端口={new_port}, 波特率={new_baudrate}, 查询间隔={self.query_interval}秒\n")
 
-        if restart_needed:
-            # 重置电量获取标志，以便重新获取电量
-            self.battery_acquired = False
-            if hasattr(self, 'status_label'):
-                self.status_label.config(text="等待获取电量...")
-            self.start_reading()
+        if reconfig_needed:
+            self.request_reconfigure()
 
     def start_reading(self):
-        if not self.running:
-            self.running = True
+        # 原子地置位运行标志，已在运行时直接返回
+        if not self.update_state(running=True).running:
             if hasattr(self, 'start_button'):
                 self.start_button.config(state=tk.DISABLED)
             if hasattr(self, 'stop_button'):
                 self.stop_button.config(state=tk.NORMAL)
 
-            self.thread = threading.Thread(target=self.read_serial)
+            # 配置了设备群共享内存表时直接读取表中的最新值
+            target = self.read_fleet if self.fleet_table else self.read_serial
+            self.thread = threading.Thread(target=target)
             self.thread.daemon = True  # 设为守护线程，避免退出时挂起
             self.thread.start()
             self.display_data("串口监控已启动\n")
 
     def stop_reading(self):
-        if self.running:
-            self.running = False
+        if self.update_state(running=False).running:
             if hasattr(self, 'start_button'):
                 self.start_button.config(state=tk.NORMAL)
             if hasattr(self, 'stop_button'):
@@ -747,95 +994,357 @@ class BatteryMonitorApp:
             self.display_data("串口监控已停止\n")
 
             # 关闭串口连接
-            if self.serial_port and hasattr(self.serial_port, 'is_open') and self.serial_port.is_open:
-                self.serial_port.close()
+            serial_port = self.state.serial_port
+            if serial_port and hasattr(serial_port, 'is_open') and serial_port.is_open:
+                serial_port.close()
                 self.display_data("已关闭串口连接\n")
 
     def read_serial(self):
         try:
-            self.serial_port = serial.Serial(self.port, int(self.baudrate), timeout=0.1)
-            self.serial_port.write(b'at+adb\r\n')
-            self.display_data(f"成功连接到 {self.port} (波特率: {self.baudrate})\n")
+            # 以当前设置打开串口，之前未应用的设置请求随之失效
+            self.pending_reconfig = None
+            serial_port, snapshot = self.open_serial()
+            self.update_state(serial_port=serial_port)
+            state = self.state
+            # 每次连接使用新的查询流水线，重新探测设备支持的命令
+            self.query_pipeline = self.build_query_pipeline()
+            self.send_query()
+            self.display_data(f"成功连接到 {state.port} (波特率: {state.baudrate})\n")
+            # 上次可用的串口在探测时已应答电量，立即应用
+            if snapshot is not None:
+                self.apply_snapshot(snapshot)
 
             # 通信策略：未获取电量前快速查询，获取后定时查询
             fast_query_time = time.time()  # 记录上次快速查询时间
 
-            while self.running:
+            while self.state.running:
                 try:
-                    # 读取可用数据
-                    data = self.serial_port.readline()
-                    if data:
+                    # 按需运行 cProfile（仅在请求分析时生效）
+                    self.profiler.poll()
+
+                    # 应用设置界面或菜单提交的串口设置变更
+                    request = self.pending_reconfig
+                    if request is not None:
+                        self.pending_reconfig = None
+                        self.apply_reconfig(*request)
+
+                    # 读取本轮所有可用的应答行
+                    with self.tracer.span("readline"):
+                        lines = self.read_available_lines()
+                    for data in lines:
                         data_str = data.decode(errors='replace')
                         self.display_data(data_str)
                         self.check_battery_status(data_str)
 
                     current_time = time.time()
 
+                    # 本轮查询的所有命令都已应答或超时后，应用合并快照
+                    snapshot = self.query_pipeline.poll(current_time)
+                    if snapshot:
+                        self.apply_snapshot(snapshot)
+
                     # 如果尚未获取电量，使用快速查询策略（每0.5秒一次）
-                    if not self.battery_acquired:
+                    if not self.state.battery_acquired:
                         if current_time - fast_query_time >= 0.5:
-                            if self.running:
-                                self.serial_port.write(b'at+adb\r\n')
+                            if self.state.running:
+                                self.send_query()
                                 fast_query_time = current_time
                                 self.display_data("发送查询命令 (快速模式)\n")
                     else:
                         # 已获取电量，按设定的时间间隔查询
                         if current_time - fast_query_time >= self.query_interval:
-                            if self.running:
-                                self.serial_port.write(b'at+adb\r\n')
+                            if self.state.running:
+                                self.send_query()
                                 fast_query_time = current_time
                                 self.display_data(f"发送查询命令 (间隔 {self.query_interval}秒)\n")
 
                     # 短暂休眠，避免CPU占用过高
-                    time.sleep(0.1)
+                    time.sleep(self.poll_delay)
 
                 except Exception as e:
                     self.display_data(f"读取数据错误: {str(e)}\n")
-                    time.sleep(1)
+                    time.sleep(self.error_delay)
 
         except Exception as e:
             self.display_data(f"串口错误: {str(e)}\n")
             # 在出错后尝试自动重连
-            time.sleep(5)
-            if self.running:
+            time.sleep(self.reconnect_delay)
+            if self.state.running:
                 self.display_data("尝试重新连接...\n")
-                self.battery_acquired = False  # 重置电量获取状态
+                self.update_state(battery_acquired=False)  # 重置电量获取状态
                 if hasattr(self, 'status_label'):
                     self.status_label.config(text="等待获取电量...")
                 threading.Thread(target=self.read_serial, daemon=True).start()
                 return
         finally:
-            if self.serial_port and hasattr(self.serial_port, 'is_open') and self.serial_port.is_open:
-                self.serial_port.close()
+            serial_port = self.state.serial_port
+            if serial_port and hasattr(serial_port, 'is_open') and serial_port.is_open:
+                serial_port.close()
                 self.display_data("已关闭串口连接\n")
 
+    def open_serial(self):
+        """打开串口，返回 (串口, 探测快照)。
+
+        启动后首次连接时优先尝试上次可用的串口设置，但只有它在探测时间内应答电量才使用，
+        并且只在此时才把当前设置改为该串口；否则关闭它，打开配置的串口，探测快照为 None。
+        """
+        state = self.state
+        warm_connection = self.warm_connection
+        self.warm_connection = None
+        if warm_connection and warm_connection != (state.port, state.baudrate):
+            port, baudrate = warm_connection
+            try:
+                serial_port = self.serial_factory(port, int(baudrate), timeout=self.serial_timeout)
+            except Exception as e:
+                self.display_data(f"上次可用的串口 {port} 无法打开: {str(e)}\n")
+            else:
+                snapshot = self.probe_serial(serial_port, self.build_query_pipeline())
+                if snapshot is not None:
+                    self.update_state(port=port, baudrate=baudrate)
+                    self.display_data(f"使用上次可用的串口设置 {port} (波特率: {baudrate})\n")
+                    return serial_port, snapshot
+                serial_port.close()
+                self.display_data(f"上次可用的串口 {port} 无应答，改用配置的串口 {state.port}\n")
+        return self.serial_factory(state.port, int(state.baudrate), timeout=self.serial_timeout), None
+
+    def read_fleet(self):
+        """从设备群共享内存表读取当前串口的最新电量，无需打开串口"""
+        try:
+            table = LatestValueTable.attach(self.fleet_table)
+        except Exception as e:
+            self.display_data(f"连接共享内存表失败: {str(e)}\n")
+            self.update_state(running=False)
+            return
+
+        self.display_data(f"已连接共享内存表 {self.fleet_table}，读取 {self.state.port} 的电量\n")
+        last_timestamp = None
+        try:
+            while True:
+                state = self.state
+                if not state.running:
+                    break
+                self.profiler.poll()
+                row = table.find(state.port)
+                if row:
+                    _, percentage, status, timestamp = row
+                    if status == STATUS_OK and percentage is not None and timestamp != last_timestamp:
+                        last_timestamp = timestamp
+                        self.update_battery(str(percentage))
+                time.sleep(0.5)
+        finally:
+            table.close()
+
+    def apply_reconfig(self, port, baudrate, timeout):
+        """在串口线程中应用串口设置：波特率和超时原地修改，串口变化时先验证新串口"""
+        serial_port = self.state.serial_port
+        if port != serial_port.port:
+            self.switch_port(port, baudrate, timeout)
+            return
+
+        if serial_port.baudrate != baudrate:
+            serial_port.baudrate = baudrate
+            self.display_data(f"已在当前连接上应用波特率 {baudrate}\n")
+        if serial_port.timeout != timeout:
+            serial_port.timeout = timeout
+            self.display_data(f"已在当前连接上应用读取超时 {timeout}秒\n")
+
+    def probe_serial(self, serial_port, pipeline, probe_time=2.0):
+        """向串口发送查询，在 probe_time 秒内收到电量应答时返回合并快照，否则返回 None"""
+        snapshot = None
+        try:
+            pipeline.begin()
+            serial_port.write(pipeline.build_request())
+            deadline = time.time() + probe_time
+            while self.state.running and snapshot is None and time.time() < deadline:
+                data = serial_port.readline()
+                if data:
+                    pipeline.feed(data.decode(errors='replace'))
+                snapshot = pipeline.poll()
+                if snapshot is not None and 'percentage' not in snapshot:
+                    # 电量命令没有应答，重新发送直到超时
+                    snapshot = None
+                    pipeline.begin()
+                    serial_port.write(pipeline.build_request())
+        except Exception as e:
+            self.display_data(f"验证 {serial_port.port} 时出错: {str(e)}\n")
+        return snapshot
+
+    def switch_port(self, port, baudrate, timeout, probe_time=2.0):
+        """打开新串口并发送查询，收到电量应答后才切换；期间继续显示上一次的读数"""
+        old_serial = self.state.serial_port
+        old_port = old_serial.port
+        self.display_data(f"正在验证新串口 {port}...\n")
+        try:
+            new_serial = self.serial_factory(port, baudrate, timeout=timeout)
+        except Exception as e:
+            self.display_data(f"无法打开 {port}: {str(e)}，继续使用 {old_port}\n")
+            self.revert_port(old_serial)
+            return
+
+        pipeline = self.build_query_pipeline()
+        snapshot = self.probe_serial(new_serial, pipeline, probe_time)
+        if snapshot is None:
+            new_serial.close()
+            self.display_data(f"{port} 无应答，继续使用 {old_port}\n")
+            self.revert_port(old_serial)
+            return
+
+        # 新串口已应答，切换并关闭旧串口
+        self.update_state(serial_port=new_serial)
+        self.query_pipeline = pipeline
+        old_serial.close()
+        self.display_data(f"已切换到 {port} (波特率: {baudrate})\n")
+        self.apply_snapshot(snapshot)
+
+    def revert_port(self, old_serial):
+        """新串口不可用时恢复为当前正在使用的串口及其波特率和读取超时"""
+        self.update_state(port=old_serial.port, baudrate=old_serial.baudrate)
+        self.serial_timeout = old_serial.timeout
+        self.save_config()
+        self.update_menu()
+        if hasattr(self, 'port_combo'):
+            self.port_combo.set(old_serial.port)
+        if hasattr(self, 'baudrate_combo'):
+            self.baudrate_combo.set(old_serial.baudrate)
+        if hasattr(self, 'timeout_combo'):
+            self.timeout_combo.set(old_serial.timeout)
+
+    def send_query(self):
+        """一次写入所有启用的查询命令，开始新的查询周期"""
+        previous = self.query_pipeline.begin()
+        self.state.serial_port.write(self.query_pipeline.build_request())
+        # 上一周期未完成时，先应用已收到的部分结果
+        if previous:
+            self.apply_snapshot(previous)
+
+    def read_available_lines(self):
+        """读取一行应答，并继续读取缓冲区中已到达的其余行"""
+        serial_port = self.state.serial_port
+        lines = []
+        data = serial_port.readline()
+        while data:
+            lines.append(data)
+            if not serial_port.in_waiting:
+                break
+            data = serial_port.readline()
+        return lines
+
     def check_battery_status(self, data):
-        """检查数据中是否包含电池信息并更新状态"""
-        match = re.search(r'\+BATCG=\d+,(?P<percentage>\d+),', data)
-        if match:
-            percentage = match.group('percentage')
-            self.current_battery = percentage
-
-            # 第一次获取电量时更新状态
-            if not self.battery_acquired:
-                self.battery_acquired = True
-                self.display_data("成功获取电量！切换到定时查询模式\n")
-                if hasattr(self, 'status_label'):
-                    self.status_label.config(text=f"已获取电量，每 {self.query_interval} 秒更新一次")
+        """把应答行交给查询流水线解析"""
+        with self.tracer.span("parse"):
+            self.query_pipeline.feed(data)
+
+    def apply_snapshot(self, snapshot):
+        """应用一个查询周期的合并快照"""
+        telemetry = {key: value for key, value in snapshot.items() if key not in ('percentage', 'timestamp')}
+        if 'percentage' in snapshot:
+            self.update_battery(str(snapshot['percentage']), telemetry)
+        else:
+            self.update_state(telemetry=telemetry)
+
+    def battery_title(self, state):
+        """托盘提示文本：电量及附加遥测数据"""
+        title = f"电池电量: {state.current_battery}%"
+        if state.stale:
+            reading_time = time.strftime("%m-%d %H:%M", time.localtime(state.reading_time))
+            title += f" (上次读数 {reading_time}，等待更新)"
+        telemetry = format_telemetry(state.telemetry)
+        if telemetry:
+            title += f" | {telemetry}"
+        analysis = state.analysis
+        if 'time_to_empty' in analysis:
+            title += f" | 约{format_hours(analysis['time_to_empty'][0])}耗尽"
+        elif 'time_to_full' in analysis:
+            title += f" | 约{format_hours(analysis['time_to_full'][0])}充满"
+        return title
+
+    def get_analyzer(self, port):
+        """获取（必要时创建）指定串口的读数历史分析器"""
+        analyzer = self.analyzers.get(port)
+        if analyzer is None:
+            file_name = port.replace('/', '_').replace('\\', '_') + ".bin"
+            analyzer = BatteryAnalyzer(ReadingHistory(os.path.join(self.history_dir, file_name)))
+            self.analyzers[port] = analyzer
+        return analyzer
+
+    def record_reading(self, port, percentage):
+        """记录读数并增量更新分析结果，返回新的分析结果"""
+        try:
+            analyzer = self.get_analyzer(port)
+            analyzer.history.append(time.time(), int(percentage))
+            return analyzer.summary()
+        except Exception as e:
+            self.display_data(f"电池分析失败: {str(e)}\n")
+            return {}
+
+    def analysis_text(self, analysis):
+        """设置面板中显示的分析结果"""
+        if 'rate' not in analysis:
+            return "读数不足，暂无分析结果"
+
+        lines = [f"当前速率: {analysis['rate']:+.1f}%/小时"]
+        if 'time_to_empty' in analysis:
+            estimate, low, high = analysis['time_to_empty']
+            lines.append(f"预计耗尽: {format_hours(estimate)} (95%区间 {format_hours(low)} ~ {format_hours(high)})")
+        if 'time_to_full' in analysis:
+            estimate, low, high = analysis['time_to_full']
+            lines.append(f"预计充满: {format_hours(estimate)} (95%区间 {format_hours(low)} ~ {format_hours(high)})")
+
+        health = analysis.get('health')
+        if health:
+            lines.append(f"满电续航: 约{format_hours(health['runtime'])} (基于 {health['sessions']} 次放电)")
+            if health['health'] is not None:
+                lines.append(f"健康度: {health['health']:.0f}%")
+            if health['fade_per_30d'] is not None:
+                lines.append(f"续航衰减: 每30天 {health['fade_per_30d']:.1f}%")
+        return "\n".join(lines)
+
+    def update_battery(self, percentage, telemetry=None):
+        """更新电量并刷新托盘图标、提示文本和菜单"""
+        with self.tracer.span("publish"):
+            self._update_battery(percentage, telemetry)
+
+    def _update_battery(self, percentage, telemetry):
+        # 记录读数并更新分析结果
+        with self.tracer.span("analyze"):
+            analysis = self.record_reading(self.state.port, percentage)
+
+        # 电量、获取标志、遥测和分析结果在同一个快照中发布
+        changes = {'current_battery': percentage, 'battery_acquired': True, 'analysis': analysis,
+                   'reading_time': time.time(), 'stale': False}
+        if telemetry is not None:
+            changes['telemetry'] = telemetry
+        previous = self.update_state(**changes)
+        state = self.state
+        self.working_connection = (state.port, state.baudrate)
+
+        # 第一次获取电量时更新状态
+        if not previous.battery_acquired:
+            self.display_data("成功获取电量！切换到定时查询模式\n")
+            if hasattr(self, 'status_label'):
+                self.status_label.config(text=f"已获取电量，每 {self.query_interval} 秒更新一次")
 
-            # 更新托盘图标
+        # 更新托盘图标
+        with self.tracer.span("render"):
             new_icon = self.create_icon_by_style(percentage)
+        with self.tracer.span("icon_swap"):
             self.icon.icon = new_icon
 
             # 更新托盘图标提示文本
-            self.icon.title = f"电池电量: {percentage}%"
+            self.icon.title = self.battery_title(state)
 
-            # 更新设置窗口中的电量显示（如果存在）
-            if hasattr(self, 'battery_label'):
-                self.battery_label.config(text=f"当前电量: {percentage}%")
+        # 更新设置窗口中的电量显示（如果存在）
+        if hasattr(self, 'battery_label'):
+            self.battery_label.config(text=f"当前电量: {percentage}%")
+        if hasattr(self, 'analysis_label'):
+            self.analysis_label.config(text=self.analysis_text(state.analysis))
 
-            # 更新菜单，显示当前电量
-            self.update_menu()
+        # 更新菜单，显示当前电量
+        self.update_menu()
+
+        # 定期保存运行状态，供下次启动时立即显示
+        if time.time() - self.last_state_save >= self.state_save_interval:
+            self.save_warm_state()
 
     def display_data(self, data):
         # 添加时间戳
@@ -858,6 +1367,11 @@ class BatteryMonitorApp:
 
     def exit_app(self):
         self.stop_reading()
+        # 保存运行状态，下次启动时立即显示
+        self.save_warm_state()
+        # 命令行开启追踪时，退出前自动导出
+        if self.tracer.enabled and self.trace_on_exit:
+            self.export_trace(self.trace_output)
         # 先停止图标，然后调度退出
         self.icon.stop()
         # 使用threading模块创建一个延迟退出的线程
@@ -868,7 +1382,23 @@ class BatteryMonitorApp:
         self.icon.run()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="电池电量监控")
+    parser.add_argument('--trace', nargs='?', const='', default=None, metavar='FILE',
+                        help="启动时开启性能追踪，退出时导出到指定文件（默认保存到分析目录）")
+    parser.add_argument('--profile', choices=['cprofile', 'sample'], help="启动后立即运行性能分析")
+    parser.add_argument('--profile-seconds', type=int, default=10, help="性能分析时长（秒）")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     app = BatteryMonitorApp()
+    if args.trace is not None:
+        app.trace_on_exit = True
+        app.trace_output = args.trace or None
+        app.tracer.enabled = True
+    if args.profile:
+        app.profiler.start(args.profile, args.profile_seconds)
     # 运行托盘图标
     app.run()
\ No newline at end of file
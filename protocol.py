@@ -0,0 +1,275 @@
+"""串口查询协议：设备协议注册表，以及把多条 AT 命令合并为一次写入、
+把交错返回的应答解析为一份合并快照的查询流水线。"""
+import re
+import time
+
+
+def decode_millivolts(value):
+    """毫伏转换为伏"""
+    return int(value) / 1000
+
+
+def decode_flag(value):
+    return value != '0'
+
+
+# 配置文件中自定义协议可使用的字段解码函数
+DECODERS = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'millivolts': decode_millivolts,
+    'flag': decode_flag,
+}
+
+# 设备对不支持的命令返回的错误应答
+ERROR_PATTERN = r'^\s*(?:ERROR|\+CME ERROR)'
+
+_GROUP_PATTERN = re.compile(r'\(\?P([<=])(\w+)')
+
+
+class QueryCommand:
+    """一条查询命令：命令字节、应答格式以及各字段的解码函数"""
+
+    def __init__(self, name, command, pattern, fields, timeout=0.4, max_failures=3, default=False):
+        self.name = name
+        self.command = command
+        self.pattern = re.compile(pattern)
+        self.fields = fields  # 字段名 -> 解码函数
+        self.timeout = timeout  # 单条命令的应答超时（秒）
+        self.max_failures = max_failures  # 连续失败多少次后视为设备不支持
+        self.default = default  # 是否默认发送，否则需在配置的 query_commands 中开启
+
+    def decode(self, match, prefix=''):
+        return {field: decoder(match.group(prefix + field)) for field, decoder in self.fields.items()}
+
+
+class DeviceProtocol:
+    """一个设备系列的协议：它支持的查询命令、应答格式和字段解码"""
+
+    def __init__(self, name, commands):
+        self.name = name
+        self.commands = {command.name: command for command in commands}
+
+    @classmethod
+    def from_config(cls, config):
+        """从配置文件中的字典创建协议，字段解码函数使用 DECODERS 中的名称。
+
+        字段必须是应答格式中的命名分组，且应答格式必须能合并进 CombinedMatcher，
+        否则抛出 ValueError，避免无效的自定义协议在读取时才出错。
+        """
+        commands = []
+        for item in config['commands']:
+            fields = {field: DECODERS[decoder] for field, decoder in item['fields'].items()}
+            command = QueryCommand(
+                item['name'],
+                item['command'].encode(),
+                item['pattern'],
+                fields,
+                timeout=item.get('timeout', 0.4),
+                max_failures=item.get('max_failures', 3),
+                default=item.get('default', 'percentage' in fields),
+            )
+            missing = [field for field in fields if field not in command.pattern.groupindex]
+            if missing:
+                raise ValueError(f"命令 {command.name} 的字段 {', '.join(missing)} 不是应答格式中的命名分组")
+            commands.append(command)
+        try:
+            CombinedMatcher(commands)
+        except re.error as e:
+            raise ValueError(f"应答格式无法合并匹配: {str(e)}") from e
+        return cls(config['name'], commands)
+
+
+class ProtocolRegistry:
+    """设备协议注册表"""
+
+    def __init__(self):
+        self.protocols = {}
+
+    def register(self, protocol):
+        """注册协议，同名协议会被替换"""
+        self.protocols[protocol.name] = protocol
+        return protocol
+
+    def get(self, name):
+        return self.protocols[name]
+
+    def select(self, protocol_names, command_names=()):
+        """选出启用的协议中要发送的命令：各协议的默认命令，加上按名称额外开启的命令"""
+        commands = []
+        for protocol_name in protocol_names:
+            protocol = self.protocols.get(protocol_name)
+            if protocol is None:
+                continue
+            for command in protocol.commands.values():
+                if command.default or command.name in command_names:
+                    commands.append(command)
+        return commands
+
+
+class CombinedMatcher:
+    """把所有命令的应答格式编译为一个正则表达式，每行应答只需扫描一次。
+
+    每条命令的格式被包裹为命名分组 c<序号>，其内部字段分组加上 c<序号>_ 前缀以避免重名；
+    匹配成功后由最外层分组名直接定位到对应命令。
+    """
+
+    def __init__(self, commands):
+        self.commands = list(commands)
+        alternatives = []
+        for index, command in enumerate(self.commands):
+            prefix = f"c{index}_"
+            pattern = _GROUP_PATTERN.sub(lambda m: f"(?P{m.group(1)}{prefix}{m.group(2)}", command.pattern.pattern)
+            alternatives.append(f"(?P<c{index}>{pattern})")
+        alternatives.append(f"(?P<error>{ERROR_PATTERN})")
+        self.regex = re.compile("|".join(alternatives))
+
+    def match(self, line):
+        """返回 (命令, 字段)；错误应答返回 (None, None)；无法识别返回 None"""
+        match = self.regex.search(line)
+        if match is None:
+            return None
+        if match.lastgroup == 'error':
+            return None, None
+        index = int(match.lastgroup[1:])
+        command = self.commands[index]
+        return command, command.decode(match, f"c{index}_")
+
+
+# 内置协议
+PROTOCOLS = ProtocolRegistry()
+PROTOCOLS.register(DeviceProtocol('tntgo', [
+    QueryCommand('battery', b'at+adb', r'\+BATCG=\d+,(?P<percentage>\d+),',
+                 {'percentage': int}, default=True),
+    # 以下命令需按设备固件支持情况在配置中开启
+    QueryCommand('voltage', b'at+batvol', r'\+BATVOL=(?P<voltage>\d+)',
+                 {'voltage': decode_millivolts}),
+    QueryCommand('temperature', b'at+battemp', r'\+BATTEMP=(?P<temperature>-?\d+(?:\.\d+)?)',
+                 {'temperature': float}),
+    QueryCommand('charge_state', b'at+chgsta', r'\+CHGSTA=(?P<charging>\d)',
+                 {'charging': decode_flag}),
+]))
+
+DEFAULT_PROTOCOLS = ['tntgo']
+
+
+class QueryPipeline:
+    """一次写入多条命令，收集应答，每个查询周期产出一份合并快照。
+
+    AT 设备按顺序处理命令，因此错误应答归属于最早仍在等待的命令。
+    命令连续失败（错误或超时）达到上限后会被停用，不再发送；
+    但最后一条能提供电量的命令始终保留。
+
+    超时后才到达或设备主动上报的电量应答不属于任何等待中的命令，
+    仍会作为单独的快照由下一次 poll() 返回。
+    """
+
+    def __init__(self, commands, log=None):
+        self.commands = list(commands)
+        self.log = log or (lambda message: None)
+        self.failures = {command: 0 for command in self.commands}
+        self.matcher = CombinedMatcher(self.commands)
+        self.pending = {}  # 命令 -> 截止时间，按发送顺序排列
+        self.results = {}
+        self.started = None
+        self.late = None  # 等待窗口之外收到的电量应答
+
+    @property
+    def in_flight(self):
+        return self.started is not None
+
+    def build_request(self):
+        """把所有启用的命令拼接为一次写入"""
+        return b''.join(command.command + b'\r\n' for command in self.commands)
+
+    def begin(self, now=None):
+        """开始新的查询周期；上一周期若未结束，返回其已收集到的部分结果"""
+        now = time.time() if now is None else now
+        previous = self.finish()
+        self.pending = {command: now + command.timeout for command in self.commands}
+        self.results = {}
+        self.started = now
+        return previous
+
+    def finish(self):
+        """立即结束当前周期（不计为失败），返回已收集的结果或 None"""
+        if self.started is None:
+            return None
+        snapshot = self._snapshot()
+        self.pending = {}
+        self.results = {}
+        self.started = None
+        return snapshot
+
+    def feed(self, line, now=None):
+        """解析一行应答，返回是否匹配到某条命令"""
+        result = self.matcher.match(line)
+        if result is None:
+            return False
+        command, fields = result
+        if command is None:
+            # 错误应答归属于最早仍在等待的命令
+            if self.pending:
+                command = next(iter(self.pending))
+                del self.pending[command]
+                self._record_failure(command, "错误应答")
+            return False
+        if command not in self.pending:
+            # 迟到或主动上报的电量应答照常更新读数，并说明设备支持该命令
+            if 'percentage' not in fields:
+                return False
+            self.failures[command] = 0
+            self.late = dict(fields, timestamp=time.time() if now is None else now)
+            return True
+        self.results.update(fields)
+        del self.pending[command]
+        self.failures[command] = 0
+        return True
+
+    def poll(self, now=None):
+        """检查超时；周期内所有命令都有结果时返回合并快照，否则返回 None。
+        收到过等待窗口之外的电量应答时，先返回它"""
+        if self.late is not None:
+            late, self.late = self.late, None
+            return late
+        if self.started is None:
+            return None
+        now = time.time() if now is None else now
+        for command, deadline in list(self.pending.items()):
+            if now >= deadline:
+                del self.pending[command]
+                self._record_failure(command, "应答超时")
+        if self.pending:
+            return None
+        return self.finish()
+
+    def _snapshot(self):
+        if not self.results:
+            return None
+        snapshot = dict(self.results)
+        snapshot['timestamp'] = self.started
+        return snapshot
+
+    def _record_failure(self, command, reason):
+        self.failures[command] += 1
+        if self.failures[command] < command.max_failures:
+            return
+        remaining = [c for c in self.commands if c is not command]
+        if 'percentage' in command.fields and not any('percentage' in c.fields for c in remaining):
+            return
+        self.commands = remaining
+        self.matcher = CombinedMatcher(self.commands)
+        self.log(f"命令 {command.name} 连续{reason}，设备可能不支持，已停用\n")
+
+
+def format_telemetry(snapshot):
+    """把快照中的附加遥测数据格式化为简短文本"""
+    parts = []
+    if snapshot.get('voltage') is not None:
+        parts.append(f"{snapshot['voltage']:.2f}V")
+    if snapshot.get('temperature') is not None:
+        parts.append(f"{snapshot['temperature']:.1f}°C")
+    if snapshot.get('charging') is not None:
+        parts.append("充电中" if snapshot['charging'] else "未充电")
+    return " | ".join(parts)
@@ -0,0 +1,359 @@
+"""长时间浸泡测试：用模拟设备以加速的查询频率驱动托盘程序数小时，
+定期记录 tracemalloc、线程数、打开的文件句柄数和 RSS，并在报告中标记持续增长的指标。
+
+用法：python soak.py --hours 4 --report soak_report.json
+存在持续增长时以退出码 1 结束，可用于发布前的门禁检查。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import serial
+
+from main import BatteryMonitorApp
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+NOMINAL_QUERY_INTERVAL = 30  # 实际使用中的默认查询间隔（秒），用于折算等效运行时间
+WARMUP_FRACTION = 0.1  # 判断增长时忽略的预热阶段比例
+
+# 各指标被判定为泄漏所需的最小增长量（首尾四分位中位数之差）：(绝对值, 相对起始值的比例)，取较大者
+# rss 和 traced 已扣除读数历史和会话缓存按设计占用的内存
+GROWTH_THRESHOLDS = {
+    'rss': (4 * 1024 * 1024, 0.05),
+    'traced': (1024 * 1024, 0.05),
+    'threads': (1, 0),
+    'fds': (2, 0),
+}
+
+
+class DeviceSimulator:
+    """模拟的设备：维护电量变化，并按概率模拟串口打开失败（设备被拔出）"""
+
+    def __init__(self, open_failure_rate=0.0, drain_every=20, seed=None):
+        self.open_failure_rate = open_failure_rate
+        self.drain_every = drain_every  # 每多少次查询电量变化1%
+        self.random = random.Random(seed)
+        self.percentage = 100
+        self.charging = False
+        self.queries = 0
+        self.opens = 0
+        self.open_failures = 0
+        self.lock = threading.Lock()
+
+    def open(self, port, baudrate=115200, timeout=None):
+        """与 serial.Serial 相同的调用方式，作为 BatteryMonitorApp 的 serial_factory"""
+        with self.lock:
+            self.opens += 1
+            if self.random.random() < self.open_failure_rate:
+                self.open_failures += 1
+                raise serial.SerialException(f"模拟设备 {port} 未连接")
+        return SimulatedSerial(self, port, baudrate, timeout)
+
+    def battery_reply(self):
+        with self.lock:
+            self.queries += 1
+            if self.queries % self.drain_every == 0:
+                if self.charging:
+                    self.percentage += 1
+                    self.charging = self.percentage < 100
+                else:
+                    self.percentage -= 1
+                    self.charging = self.percentage <= 5
+            millivolts = 3300 + self.percentage * 9
+            return f"+BATCG={int(self.charging)},{self.percentage},{millivolts},\r\n"
+
+
+class SimulatedSerial:
+    """实现托盘程序用到的 pyserial 接口子集"""
+
+    def __init__(self, simulator, port, baudrate, timeout):
+        self.simulator = simulator
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.replies = []
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException("串口未打开")
+        for line in data.split(b'\r\n'):
+            command = line.strip().lower()
+            if not command:
+                continue
+            if command == b'at+adb':
+                self.replies.append(self.simulator.battery_reply().encode())
+                self.replies.append(b'OK\r\n')
+            else:
+                self.replies.append(b'ERROR\r\n')
+        return len(data)
+
+    def readline(self):
+        if not self.is_open:
+            raise serial.SerialException("串口未打开")
+        if self.replies:
+            return self.replies.pop(0)
+        if self.timeout:
+            time.sleep(self.timeout)
+        return b''
+
+    @property
+    def in_waiting(self):
+        return sum(len(reply) for reply in self.replies)
+
+    def close(self):
+        self.is_open = False
+        self.replies = []
+
+
+def rss_bytes():
+    """当前进程的常驻内存，无法获取时返回 None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def open_handle_count():
+    """当前进程打开的文件描述符（Windows 下为句柄）数量，无法获取时返回 None"""
+    if psutil is not None:
+        process = psutil.Process()
+        return process.num_handles() if os.name == 'nt' else process.num_fds()
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def analytics_bytes(app):
+    """读数历史和会话缓存按设计占用的内存（字节）。
+
+    读数历史随读数持续增长，已结束会话的统计和放电曲线随会话数增长；
+    这部分是预期的增长，从 tracemalloc 和 RSS 中扣除后再判断是否泄漏。
+    """
+    total = 0
+    for analyzer in list(app.analyzers.values()):
+        total += analyzer.history.data.nbytes
+        sessions = list(analyzer.closed_sessions)
+        total += sys.getsizeof(sessions)
+        for session in sessions:
+            total += sys.getsizeof(session)
+            total += sum(sys.getsizeof(value) for key, value in session.items() if key != 'kind')
+    analysis = app.state.analysis or {}
+    total += sys.getsizeof(analysis.get('sessions', []))
+    return total
+
+
+def history_records(app):
+    return sum(analyzer.history.size for analyzer in list(app.analyzers.values()))
+
+
+def take_sample(start, simulator, app):
+    expected = analytics_bytes(app)
+    rss = rss_bytes()
+    traced = tracemalloc.get_traced_memory()[0]
+    return {
+        'elapsed': time.time() - start,
+        'rss': None if rss is None else rss - expected,
+        'traced': traced - expected,
+        'rss_total': rss,
+        'traced_total': traced,
+        'analytics': expected,
+        'history_records': history_records(app),
+        'threads': threading.active_count(),
+        'fds': open_handle_count(),
+        'queries': simulator.queries,
+    }
+
+
+def detect_growth(values, threshold):
+    """把预热后的样本分为四段，各段中位数严格递增且增长超过阈值时判定为持续增长"""
+    absolute, relative = threshold
+    values = [value for value in values if value is not None]
+    values = values[int(len(values) * WARMUP_FRACTION):]
+    if len(values) < 8:
+        return {'flagged': False, 'reason': "样本不足"}
+    medians = [float(np.median(part)) for part in np.array_split(np.array(values, dtype=np.float64), 4)]
+    monotonic = all(a < b for a, b in zip(medians, medians[1:]))
+    growth = medians[-1] - medians[0]
+    return {
+        'first': values[0],
+        'last': values[-1],
+        'max': max(values),
+        'quarter_medians': medians,
+        'growth': growth,
+        'monotonic': monotonic,
+        'flagged': monotonic and growth >= max(absolute, relative * medians[0]),
+    }
+
+
+def measure(app, simulator, start, hours, sample_interval, reconnect_every, result):
+    """采样循环：定期记录指标并手动重连，结果写入 result"""
+    deadline = start + hours * 3600
+    warmup_end = start + hours * 3600 * WARMUP_FRACTION
+    baseline = None
+    next_reconnect = start + reconnect_every
+    samples = result['samples']
+    while time.time() < deadline:
+        time.sleep(sample_interval)
+        samples.append(take_sample(start, simulator, app))
+        if baseline is None and time.time() >= warmup_end:
+            baseline = tracemalloc.take_snapshot()
+        # 定期手动重连，覆盖串口关闭/重新打开和线程重建的路径
+        if reconnect_every and time.time() >= next_reconnect:
+            app.reconnect()
+            result['reconnects'] += 1
+            next_reconnect = time.time() + reconnect_every
+        last = samples[-1]
+        print(f"[{last['elapsed']:.0f}s] 查询 {last['queries']} 次, 线程 {last['threads']}, "
+              f"句柄 {last['fds']}, RSS {last['rss_total']}, tracemalloc {last['traced_total']}, "
+              f"读数历史 {last['history_records']} 条", flush=True)
+
+    app.stop_reading()
+
+    if baseline is not None:
+        stats = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')
+        for stat in stats[:15]:
+            frame = stat.traceback[0]
+            result['top_growth'].append({
+                'location': f"{frame.filename}:{frame.lineno}",
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+            })
+
+
+def run_soak(hours, sample_interval, poll_delay, query_interval, reconnect_every, open_failure_rate,
+             show_icon=True):
+    """运行浸泡测试并返回报告。
+
+    show_icon 为 True 时托盘图标在主线程中运行（pystray 要求），采样在单独线程中进行，
+    这样每次读数的图标替换会经过真实的托盘后端；无图形界面的环境可关闭。
+    """
+    tracemalloc.start(5)
+    data_dir = tempfile.mkdtemp(prefix="battery_soak_")
+    simulator = DeviceSimulator(open_failure_rate)
+    start = time.time()
+    result = {'samples': [], 'reconnects': 0, 'top_growth': [], 'error': None}
+
+    try:
+        app = BatteryMonitorApp(data_dir=data_dir, serial_factory=simulator.open)
+        app.poll_delay = poll_delay
+        app.error_delay = poll_delay * 10
+        app.reconnect_delay = poll_delay * 10
+        app.query_interval = query_interval
+        # 读取超时也按加速比例缩短，由串口线程在已打开的串口上原地应用
+        app.serial_timeout = poll_delay
+        app.request_reconfigure()
+
+        args = (app, simulator, start, hours, sample_interval, reconnect_every, result)
+        if show_icon:
+            def measure_then_stop():
+                try:
+                    measure(*args)
+                except Exception as e:
+                    result['error'] = e
+                finally:
+                    app.icon.stop()
+
+            def setup(icon):
+                icon.visible = True
+                threading.Thread(target=measure_then_stop, daemon=True).start()
+
+            app.icon.run(setup)
+            if result['error'] is not None:
+                raise result['error']
+        else:
+            measure(*args)
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    samples = result['samples']
+    metrics = {name: detect_growth([sample[name] for sample in samples], threshold)
+               for name, threshold in GROWTH_THRESHOLDS.items()}
+    return {
+        'config': {
+            'hours': hours,
+            'sample_interval': sample_interval,
+            'poll_delay': poll_delay,
+            'query_interval': query_interval,
+            'reconnect_every': reconnect_every,
+            'open_failure_rate': open_failure_rate,
+        },
+        'duration': time.time() - start,
+        'queries': simulator.queries,
+        'opens': simulator.opens,
+        'open_failures': simulator.open_failures,
+        'reconnects': result['reconnects'],
+        'history_records': samples[-1]['history_records'] if samples else 0,
+        'analytics_bytes': samples[-1]['analytics'] if samples else 0,
+        'icon_shown': show_icon,
+        'equivalent_uptime_days': simulator.queries * NOMINAL_QUERY_INTERVAL / 86400,
+        'metrics': metrics,
+        'top_allocation_growth': result['top_growth'],
+        'passed': not any(metric['flagged'] for metric in metrics.values()),
+        'samples': samples,
+    }
+
+
+def print_report(report):
+    print()
+    print(f"运行 {report['duration'] / 3600:.2f} 小时, 查询 {report['queries']} 次 "
+          f"(按 {NOMINAL_QUERY_INTERVAL} 秒间隔约等于 {report['equivalent_uptime_days']:.1f} 天), "
+          f"打开串口 {report['opens']} 次 (失败 {report['open_failures']} 次), 手动重连 {report['reconnects']} 次")
+    print(f"读数历史 {report['history_records']} 条, 分析数据约 {report['analytics_bytes']} 字节 "
+          f"(按设计增长，已从 rss/traced 中扣除)")
+    if not report['icon_shown']:
+        print("未运行托盘图标，图标替换路径未覆盖")
+    for name, metric in report['metrics'].items():
+        if 'growth' not in metric:
+            print(f"  {name:<8} {metric['reason']}")
+            continue
+        status = "持续增长!" if metric['flagged'] else "正常"
+        print(f"  {name:<8} 起始 {metric['first']:>12.0f}  结束 {metric['last']:>12.0f}  "
+              f"增长 {metric['growth']:>12.0f}  {status}")
+    if report['top_allocation_growth']:
+        print("内存增长最多的位置:")
+        for item in report['top_allocation_growth'][:5]:
+            print(f"  {item['size_diff']:>+10d} 字节  {item['location']}")
+    print("结果: " + ("通过" if report['passed'] else "未通过"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="电池监控浸泡测试")
+    parser.add_argument('--hours', type=float, default=4, help="运行时长（小时）")
+    parser.add_argument('--sample-interval', type=float, default=10, help="采样间隔（秒）")
+    parser.add_argument('--poll-delay', type=float, default=0.005, help="串口循环休眠时间（秒）")
+    parser.add_argument('--query-interval', type=float, default=0.02, help="获取电量后的查询间隔（秒）")
+    parser.add_argument('--reconnect-every', type=float, default=300, help="手动重连间隔（秒），0 表示不重连")
+    parser.add_argument('--open-failure-rate', type=float, default=0.2, help="模拟串口打开失败的概率")
+    parser.add_argument('--no-icon', action='store_true', help="不运行托盘图标（无图形界面的环境）")
+    parser.add_argument('--report', default="soak_report.json", help="报告文件路径")
+    args = parser.parse_args()
+
+    report = run_soak(args.hours, args.sample_interval, args.poll_delay, args.query_interval,
+                      args.reconnect_every, args.open_failure_rate, show_icon=not args.no_icon)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_report(report)
+    print(f"报告已保存到 {args.report}")
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == "__main__":
+    main()
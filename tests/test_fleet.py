@@ -0,0 +1,67 @@
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fleet import LatestValueTable, STATUS_CONNECTING, STATUS_ERROR, STATUS_OK, init_device, poll_device  # noqa: E402
+
+
+def test_write_after_crash_mid_write_keeps_slot_readable():
+    table = LatestValueTable.create(2)
+    try:
+        table.write(0, "COM3", 80, STATUS_OK, 1.0)
+        # 模拟写入方在写入中途崩溃：序列号停留在奇数
+        offset = table._offset(0)
+        seq = struct.unpack_from('<I', table.shm.buf, offset)[0]
+        struct.pack_into('<I', table.shm.buf, offset, seq + 1)
+        assert table.read(0, retries=3) is None
+
+        # 重启后的工作进程直接写入，奇偶性不能反转
+        table.write(0, "COM3", 79, STATUS_OK, 2.0)
+        assert table.read(0) == ("COM3", 79, STATUS_OK, 2.0)
+        table.write(0, "COM3", 78, STATUS_OK, 3.0)
+        assert table.read(0) == ("COM3", 78, STATUS_OK, 3.0)
+    finally:
+        table.close()
+
+
+def test_reset_restores_even_sequence():
+    table = LatestValueTable.create(1)
+    try:
+        table.write(0, "COM4", 50, STATUS_OK, 1.0)
+        offset = table._offset(0)
+        seq = struct.unpack_from('<I', table.shm.buf, offset)[0]
+        struct.pack_into('<I', table.shm.buf, offset, seq + 1)
+        table.reset(0)
+        assert table.read(0) == ("COM4", 50, STATUS_OK, 1.0)
+        assert table.find("COM4") is not None
+        table.write(0, "COM4", None, STATUS_CONNECTING, 1.0)
+        assert table.read(0) == ("COM4", None, STATUS_CONNECTING, 1.0)
+    finally:
+        table.close()
+
+
+def test_restarted_worker_keeps_last_reading():
+    table = LatestValueTable.create(1)
+    try:
+        table.write(0, "TEST_MISSING_PORT", 77, STATUS_OK, 1.0)
+        device = init_device(table, 0, "TEST_MISSING_PORT")
+        assert device['percentage'] == 77
+        assert table.read(0) == ("TEST_MISSING_PORT", 77, STATUS_CONNECTING, 1.0)
+
+        # 串口仍然无法打开时标记错误，但读数保留
+        poll_device(table, device, 2.0, 115200, 30)
+        assert table.read(0)[1:3] == (77, STATUS_ERROR)
+    finally:
+        table.close()
+
+
+def test_new_worker_starts_without_reading():
+    table = LatestValueTable.create(1)
+    try:
+        device = init_device(table, 0, "COM6")
+        assert device['percentage'] is None
+        assert table.read(0)[:3] == ("COM6", None, STATUS_CONNECTING)
+    finally:
+        table.close()
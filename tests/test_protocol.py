@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import CombinedMatcher, DeviceProtocol, QueryCommand  # noqa: E402
+
+
+def test_combined_matcher_renames_groups_and_dispatches():
+    first = QueryCommand('a', b'at+a', r'\+A=(?P<value>\d+),(?P=value)', {'value': int})
+    second = QueryCommand('b', b'at+b', r'\+B=(?P<value>\d+)', {'value': int})
+    matcher = CombinedMatcher([first, second])
+
+    assert matcher.match('+A=7,7') == (first, {'value': 7})
+    assert matcher.match('+B=42') == (second, {'value': 42})
+    assert matcher.match('ERROR') == (None, None)
+    assert matcher.match('+C=1') is None
+
+
+def custom_protocol(pattern, fields=None):
+    return {
+        'name': 'custom',
+        'commands': [{
+            'name': 'battery',
+            'command': 'at+bat',
+            'pattern': pattern,
+            'fields': fields or {'percentage': 'int'},
+        }],
+    }
+
+
+def test_from_config_rejects_unknown_field():
+    with pytest.raises(ValueError):
+        DeviceProtocol.from_config(custom_protocol(r'BAT=(?P<percent>\d+)'))
+
+
+def test_from_config_rejects_pattern_that_cannot_be_combined():
+    with pytest.raises(ValueError):
+        DeviceProtocol.from_config(custom_protocol(r'(?i)bat=(?P<percentage>\d+)'))
+
+
+def test_from_config_accepts_valid_protocol():
+    protocol = DeviceProtocol.from_config(custom_protocol(r'BAT=(?P<percentage>\d+)'))
+    command = protocol.commands['battery']
+    assert CombinedMatcher([command]).match('BAT=64') == (command, {'percentage': 64})
@@ -0,0 +1,220 @@
+"""轻量级分段追踪与按需性能分析。
+
+Tracer 在 读取 → 解析 → 绘制 → 发布 各阶段记录耗时区间，保存在有界内存缓冲区中，
+可导出为 Chrome trace-event JSON（在 chrome://tracing 或 Perfetto 中打开）。
+关闭追踪时 span() 直接返回共享的空上下文，几乎没有额外开销。
+"""
+import collections
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class _NullSpan:
+    """追踪关闭时使用的空上下文"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        # deque.append 是原子操作，多线程记录无需加锁
+        self.tracer.events.append((self.name, self.start, end - self.start, threading.get_ident()))
+        return False
+
+
+class Tracer:
+    """有界的分段追踪记录器"""
+
+    def __init__(self, capacity=20000):
+        self.enabled = False
+        self.events = collections.deque(maxlen=capacity)
+        self.origin = time.perf_counter_ns()
+
+    def span(self, name):
+        """返回一个记录耗时的上下文管理器"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def clear(self):
+        self.events.clear()
+        self.origin = time.perf_counter_ns()
+
+    def export_chrome_trace(self, path):
+        """导出为 Chrome trace-event JSON 文件，返回导出的事件数量"""
+        events = list(self.events)
+        pid = os.getpid()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        trace_events = []
+        for tid in sorted({event[3] for event in events}):
+            trace_events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': thread_names.get(tid, str(tid))},
+            })
+        for name, start, duration, tid in events:
+            trace_events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.origin) / 1000,
+                'dur': duration / 1000,
+                'pid': pid,
+                'tid': tid,
+            })
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+
+class OnDemandProfiler:
+    """按需运行 N 秒的性能分析，并把结果写入磁盘。
+
+    - "sample" 模式在独立线程中定期采样所有线程的调用栈，输出折叠栈文本（可用于火焰图）
+    - "cprofile" 模式由串口读取线程在每次循环中调用 poll()，在该线程内运行 cProfile；
+      若到期后 poll_grace 秒内仍没有线程调用 poll()（监控已停止或读取线程卡在重连中），
+      看门狗会取消本次分析，避免之后的分析请求一直被拒绝
+    """
+
+    def __init__(self, output_dir, log=print, sample_interval=0.005, poll_grace=2.0):
+        self.output_dir = output_dir
+        self.log = log
+        self.sample_interval = sample_interval
+        self.poll_grace = poll_grace
+        self.active = False
+        self.lock = threading.Lock()
+        self._cprofile_deadline = None
+        self._cprofile = None
+        self._abandoned = None  # 被看门狗取消、需由启用它的线程关闭的 cProfile
+
+    def _output_path(self, mode, suffix):
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        return os.path.join(self.output_dir, f"profile-{mode}-{stamp}{suffix}")
+
+    def start(self, mode, seconds):
+        """开始一次性能分析，已有分析在运行时返回 False"""
+        if self.active:
+            self.log("性能分析正在进行中\n")
+            return False
+        self.active = True
+        if mode == "sample":
+            threading.Thread(target=self._run_sampler, args=(seconds,), daemon=True).start()
+        elif mode == "cprofile":
+            deadline = time.time() + seconds
+            self._cprofile_deadline = deadline
+            watchdog = threading.Timer(seconds + self.poll_grace, self._expire_cprofile, args=(deadline,))
+            watchdog.daemon = True
+            watchdog.start()
+        else:
+            self.active = False
+            raise ValueError(f"未知的分析模式: {mode}")
+        self.log(f"开始性能分析 ({mode}, {seconds}秒)\n")
+        return True
+
+    def poll(self):
+        """由被分析的线程在每次循环中调用，负责启停 cProfile"""
+        if self._abandoned is not None:
+            with self.lock:
+                abandoned, self._abandoned = self._abandoned, None
+            if abandoned is not None:
+                abandoned.disable()
+        deadline = self._cprofile_deadline
+        if deadline is None:
+            return
+        with self.lock:
+            if self._cprofile_deadline != deadline:
+                return
+            if self._cprofile is None:
+                self._cprofile = cProfile.Profile()
+                self._cprofile.enable()
+                return
+            if time.time() < deadline:
+                return
+            profile = self._cprofile
+            profile.disable()
+            self._cprofile = None
+            self._cprofile_deadline = None
+        self._dump_cprofile(profile)
+        self.active = False
+
+    def _expire_cprofile(self, deadline):
+        """看门狗：到期后仍没有线程完成本次 cProfile 分析时取消它"""
+        with self.lock:
+            if self._cprofile_deadline != deadline:
+                return
+            # 已启用的 cProfile 只能由启用它的线程关闭，留待其下次调用 poll() 时处理
+            self._abandoned = self._cprofile
+            self._cprofile = None
+            self._cprofile_deadline = None
+            self.active = False
+        self.log("没有读取循环在运行，cProfile 分析已取消\n")
+
+    def _dump_cprofile(self, profile):
+        path = self._output_path("cprofile", ".prof")
+        profile.dump_stats(path)
+
+        # 同时输出一份可直接阅读的文本摘要
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(40)
+        with open(path[:-len(".prof")] + ".txt", 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        self.log(f"cProfile 结果已保存到 {path}\n")
+
+    def _run_sampler(self, seconds):
+        own_ident = threading.get_ident()
+        thread_names = {}
+        stacks = collections.Counter()
+        samples = 0
+        deadline = time.time() + seconds
+
+        try:
+            while time.time() < deadline:
+                for thread in threading.enumerate():
+                    thread_names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    parts = []
+                    while frame is not None:
+                        code = frame.f_code
+                        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    parts.append(thread_names.get(ident, str(ident)))
+                    stacks[";".join(reversed(parts))] += 1
+                samples += 1
+                time.sleep(self.sample_interval)
+
+            path = self._output_path("sample", ".txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.log(f"采样分析完成 ({samples} 次采样)，结果已保存到 {path}\n")
+        except Exception as e:
+            self.log(f"采样分析失败: {str(e)}\n")
+        finally:
+            self.active = False